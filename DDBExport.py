@@ -2,14 +2,16 @@
 This is a python script to export data from DynamoDB table into JSON files. 
 
 Usage:
-  python DDBExport.py -r <region> -t <table> -p <processes> -c <capacity> -s <size> -d <destination>
+  python DDBExport.py -r <region> -t <table> -p <processes> -c <capacity> -s <size> -d <destination> [-z]
 
 Example:
   python DDBExport.py -r us-east-1 -t TestTable1 -p 8 -c 1000 -s 1024 -d /data
   python DDBExport.py -r us-west-2 -t TestTable2 -p 8 -c 2000 -s 2048 -d s3://bucket/prefix/
+  python DDBExport.py -r us-west-2 -t TestTable2 -p 8 -c 2000 -s 2048 -d s3://bucket/prefix/ -z
   
-The script launches multiple processes to do the work. Each process Scans its own
-segment from the DynamoDB table, and writes the output to its own JSON file. 
+The script launches multiple processes to do the work. The table is split into 8
+segments per process. Each process Scans the next unclaimed segment from the DynamoDB
+table until all segments are done, and writes the output to its own JSON files. 
 
 It is safe to use 1 process per vCPU core. If you have an EC2 instance with 4 vCPU 
 cores, it is OK to set the process count to 4. 
@@ -20,87 +22,181 @@ import sys
 import json
 import time
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import multiprocessing
-import getopt
+import argparse
 import decimal
 import os
+import io
 import random
-from datetime import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+writev = getattr(os, 'writev', None)
+try:
+  iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+  iov_max = 1024
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 """
 QoSCounter is a LeakyBucket QoS algorithm. Each sub-process can not do any Scan 
 unless the QoSCounter is greater than 0. After a sub-process performs a Scan, it
 must deduct the consumed RCU from the QoSCounter by calling the consume() method. 
-The main process needs to start a separate process to call the refill() method
-at 1 Hz to refill the LeakyBucket. 
+There is no refill process. The capacity is derived on demand from the time elapsed
+since the QoSCounter was created, the refill rate and the RCU consumed so far.
 """
 class QoSCounter(object):
     def __init__(self, value=0):
         """
-        RawValue because we don't need it to create a Lock:
+        RawValue because we don't need it to create a Lock. The consumed RCU is a
+        64-bit integer, because it keeps on adding up during a long export. The start
+        time comes from the monotonic clock, which is shared by all processes.
         """
-        self.capacity   = multiprocessing.RawValue('i', value)
+        self.start      = multiprocessing.RawValue('d', time.monotonic())
+        self.consumed   = multiprocessing.RawValue('q', 0)
         self.refillRate = multiprocessing.RawValue('i', value)
         self.lock       = multiprocessing.Lock()
 
     def consume(self, value=0):
         with self.lock:
-            self.capacity.value -= value
+            self.consumed.value += value
 
-    def refill(self):
+    def value(self):
         """
         Here we assume unlimit capacity for the LeakyBucket. The underlying assumption
         is unused capacity in the previous second is counted towards burst capacity,
-        which can be used in subsequent API calls. 
-        """ 
-        with self.lock:
-            self.capacity.value += self.refillRate.value
-
-    def value(self):
-        with self.lock:
-            return self.capacity.value
+        which can be used in subsequent API calls. The bucket starts with one second
+        of capacity. Reading an aligned 64-bit integer is atomic, so the check does
+        not need the lock. 
+        """
+        rate = self.refillRate.value
+        return rate * (1 + time.monotonic() - self.start.value) - self.consumed.value
 
-"""
-This is a thread to refill the QoSCounter once every second.
-"""
-def qosRefillThread(counter):
-  while True:
-      counter.refill()
-      time.sleep(1)
+    def wait(self):
+        """
+        Block until the QoSCounter is greater than 0, by sleeping for as long as it
+        takes to earn back the deficit.
+        """
+        budget = self.value()
+        while budget <= 0:
+            time.sleep(-budget / self.refillRate.value + 0.01)
+            budget = self.value()
 
 """
-This is a method to convert Decimal into integer or float.
+This is a method to convert Decimal into integer or float. A Decimal is integral
+when its exponent is not negative, which saves converting it twice. DynamoDB trims
+trailing zeros from numbers, so an integral number never comes back as 1.0. String
+sets and number sets are returned by boto3 as Python sets, which are converted into
+lists.
 """
 def decimal_default(obj):
     if isinstance(obj, decimal.Decimal):
-      if int(obj) == obj:
-        return int(obj)
-      else:
-        return float(obj)
+      return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, set):
+      return list(obj)
     raise TypeError
+
+"""
+Serialize one item into a line of JSON, as bytes. We use orjson when it is available
+because it does the work in C. orjson only handles 64-bit integers, so an item with a
+bigger number falls back to the json module.
+"""
+def dumpItem(item):
+  if orjson is not None:
+    try:
+      return orjson.dumps(item, default=decimal_default)
+    except TypeError:
+      pass
+  return json.dumps(item, default=decimal_default).encode('utf-8')
    
+"""
+Serialize a page of items into a buffer, one item per line. The buffer is written
+into the output file in one piece, so there is no write() call and no intermediate
+string for each item. The number of bytes added to the buffer is returned.
+"""
+def writeItems(buffer, items):
+  start = len(buffer)
+  """
+  The functions used once per item are bound to local names, to save the global
+  and attribute lookups inside the loop. If orjson can not handle an item in the
+  page, the page is serialized again through dumpItem().
+  """
+  dump = dumpItem
+  if orjson is not None:
+    dumps   = orjson.dumps
+    default = decimal_default
+    try:
+      for item in items:
+        buffer += dumps(item, default=default)
+        buffer.append(10)
+      return len(buffer) - start
+    except TypeError:
+      del buffer[start:]
+  for item in items:
+    buffer += dump(item)
+    buffer.append(10)
+  return len(buffer) - start
+
+"""
+Write a list of serialized pages into the output file. An uncompressed local file is
+opened without a Python buffer, and all the pages are written with one writev() call,
+which takes as many buffers as the system allows. A short write is continued from 
+where it stopped. Everything else, and systems without writev(), go through write().
+"""
+def writeChunks(out, chunks):
+  if writev is None or not isinstance(out, io.FileIO):
+    for chunk in chunks:
+      out.write(chunk)
+    return
+  fd    = out.fileno()
+  views = [memoryview(chunk) for chunk in chunks]
+  while views:
+    written = writev(fd, views[:iov_max])
+    while views and written >= len(views[0]):
+      written = written - len(views[0])
+      views.pop(0)
+    if written > 0:
+      views[0] = views[0][written:]
+
+"""
+Exponential backoff with full jitter. The sleep time is random between zero and a
+limit which doubles with each attempt, up to 20 seconds. The exponent is capped 
+first, so a long run of attempts does not overflow the float.
+"""
+def backoff(attempt):
+  return random.uniform(0, min(20, 0.5 * (2 ** min(attempt, 6))))
+
 """
 Perform a DynamoDB Scan, with application -level retries. The application-level retries are
 in addition to the automatic retries in boto3.
 """
-def ddbScan(worker, ddb_table, total_segments, workerId, last_evaluated_key, counter):
+def ddbScan(worker, ddb_table, total_segments, segment, last_evaluated_key, counter):
   ddb_max_retries  = 3
   ddb_retry_count  = 0
   ddb_retry_needed = True
+  ddb_throttle_count = 0
   """
   Before doing any work, wait for QoSCounter to be greater than zero. 
   """
-  while counter.value() <= 0:
-    time.sleep(1)
+  counter.wait()
   """
   The QoSCounter is greater than 0. Perform the Scan 
   """
   while ddb_retry_count < ddb_max_retries and ddb_retry_needed:
     try:
       if last_evaluated_key is None:
-        response = ddb_table.scan(TotalSegments=total_segments, Segment=workerId, ReturnConsumedCapacity='TOTAL')
+        response = ddb_table.scan(TotalSegments=total_segments, Segment=segment, ReturnConsumedCapacity='TOTAL')
       else:
-        response = ddb_table.scan(TotalSegments=total_segments, Segment=workerId, ExclusiveStartKey=last_evaluated_key, ReturnConsumedCapacity='TOTAL')
+        response = ddb_table.scan(TotalSegments=total_segments, Segment=segment, ExclusiveStartKey=last_evaluated_key, ReturnConsumedCapacity='TOTAL')
       """
       Update the QoSCounter by deducting the consumed RCU from the LeakyBucket, with the 
       consume() method.
@@ -108,11 +204,26 @@ def ddbScan(worker, ddb_table, total_segments, workerId, last_evaluated_key, cou
       counter.consume(int(response['ConsumedCapacity']['CapacityUnits']))
       ddb_retry_needed = False
       return response
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ProvisionedThroughputExceededException':
+        ddb_retry_count = ddb_retry_count + 1
+        message(worker + ': ' + str(e))
+        message(worker + ': DynamoDB Scan attempt ' + str(ddb_retry_count) + ' failed.')
+        time.sleep(backoff(ddb_retry_count))
+      else:
+        """
+        Throttling is not a failure of the Scan, so it does not use up a retry. Back
+        off, then wait for the QoSCounter again before the next attempt.
+        """
+        ddb_throttle_count = ddb_throttle_count + 1
+        message(worker + ': DynamoDB Scan throttled.')
+        time.sleep(backoff(ddb_throttle_count))
+        counter.wait()
     except Exception as e:
       ddb_retry_count = ddb_retry_count + 1
       message(worker + ': ' + str(e))
       message(worker + ': DynamoDB Scan attempt ' + str(ddb_retry_count) + ' failed.')
-      time.sleep(ddb_retry_count * random.randrange(10))
+      time.sleep(backoff(ddb_retry_count))
   if ddb_retry_count >= ddb_max_retries and ddb_retry_needed:
     """
     If the application-level retries also fail, we have tried our best. It is time to
@@ -123,30 +234,100 @@ def ddbScan(worker, ddb_table, total_segments, workerId, last_evaluated_key, cou
     sys.exit()
    
 """
-Stage a file to S3, with application -level retries. The application-level retries are
+Call an S3 API, with application -level retries. The application-level retries are
 in addition to the automatic retries in boto3.
 """
-def s3Upload(worker, s3, filename, s3Bucket, s3Key):
+def s3Request(worker, action, function, **kwargs):
   s3_max_retries  = 3
   s3_retry_count  = 0
-  s3_retry_needed = True
-  while s3_retry_count < s3_max_retries and s3_retry_needed:
+  while s3_retry_count < s3_max_retries:
     try:
-      s3.meta.client.upload_file(filename, s3Bucket, s3Key)
-      s3_retry_needed = False
+      return function(**kwargs)
     except Exception as e:
       s3_retry_count = s3_retry_count + 1
       message(worker + ': ' + str(e))
-      message(worker + ': S3 upload attempt #' + str(s3_retry_count) + ' failed for ' + filename)
-      time.sleep(random.randrange(10))
-  if s3_retry_count >= s3_max_retries and s3_retry_needed:
-    """
-    If the application-level retries also fail, we have tried our best. It is time to
-    give up.
-    """
-    message(worker + ': ' + str(s3_max_retries) + ' S3 upload attempts failed for ' + filename)
-    message(worker + ': Killing DDBExport due to retry limits exceeded.')
-    sys.exit()
+      message(worker + ': S3 ' + action + ' attempt #' + str(s3_retry_count) + ' failed for ' + kwargs['Key'])
+      time.sleep(backoff(s3_retry_count))
+  """
+  If the application-level retries also fail, we have tried our best. It is time to
+  give up.
+  """
+  message(worker + ': ' + str(s3_max_retries) + ' S3 ' + action + ' attempts failed for ' + kwargs['Key'])
+  message(worker + ': Killing DDBExport due to retry limits exceeded.')
+  sys.exit()
+
+"""
+Upload one part of a multipart upload. This runs in the upload thread pool of a 
+worker, so that the worker can keep on writing. The slot taken from the upload 
+semaphore is given back when the upload is over.
+"""
+def s3UploadPart(worker, s3, s3Bucket, s3Key, uploadId, partNumber, body, slots):
+  try:
+    response = s3Request(worker, 'upload part', s3.upload_part, Bucket=s3Bucket, Key=s3Key, UploadId=uploadId, PartNumber=partNumber, Body=body)
+    return {'ETag': response['ETag'], 'PartNumber': partNumber}
+  finally:
+    slots.release()
+
+"""
+S3StreamWriter is a file-like object that writes directly into an S3 object, without
+staging the data on local disk. The data is buffered in memory and sent with S3
+multipart upload, one part for every 8 MB. The parts are uploaded in the background
+by the upload thread pool of the worker, and the upload semaphore limits the number
+of parts held in memory. A file smaller than one part is sent with a single PutObject.
+"""
+class S3StreamWriter(object):
+    def __init__(self, worker, s3, s3Bucket, s3Key, uploader, slots, partSize=8*1024*1024):
+        self.worker   = worker
+        self.s3       = s3
+        self.s3Bucket = s3Bucket
+        self.s3Key    = s3Key
+        self.uploader = uploader
+        self.slots    = slots
+        self.partSize = partSize
+        self.buffer   = bytearray()
+        self.uploadId = None
+        self.parts    = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.partSize:
+            self.uploadPart()
+        return len(data)
+
+    def uploadPart(self):
+        if self.uploadId is None:
+            response = s3Request(self.worker, 'create multipart upload', self.s3.create_multipart_upload, Bucket=self.s3Bucket, Key=self.s3Key)
+            self.uploadId = response['UploadId']
+        self.slots.acquire()
+        self.parts.append(self.uploader.submit(s3UploadPart, self.worker, self.s3, self.s3Bucket, self.s3Key, self.uploadId, len(self.parts) + 1, bytes(self.buffer), self.slots))
+        self.buffer = bytearray()
+
+    def close(self):
+        """
+        If an upload gave up after too many failed attempts, result() raises the
+        SystemExit from s3Request() in this thread.
+        """
+        if self.uploadId is None:
+            s3Request(self.worker, 'upload', self.s3.put_object, Bucket=self.s3Bucket, Key=self.s3Key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            self.uploadPart()
+        try:
+            parts = [part.result() for part in self.parts]
+        except BaseException:
+            self.abort()
+            raise
+        s3Request(self.worker, 'complete multipart upload', self.s3.complete_multipart_upload, Bucket=self.s3Bucket, Key=self.s3Key, UploadId=self.uploadId, MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        """
+        Give up on the object. Parts still in flight are waited for, so that nothing
+        gets uploaded after the multipart upload is aborted.
+        """
+        if self.uploadId is not None:
+            for part in self.parts:
+                part.exception()
+            self.s3.abort_multipart_upload(Bucket=self.s3Bucket, Key=self.s3Key, UploadId=self.uploadId)
 
 """
 Retrieve the AWS region for the S3 bucket.
@@ -167,9 +348,7 @@ def getBucketRegion(bucket):
 Get the string representation of the current day and time.
 """   
 def getTime():
-  now = datetime.now()
-  current_time = now.strftime("%Y-%m-%dT%H:%M:%S")
-  return current_time
+  return time.strftime("%Y-%m-%dT%H:%M:%S")
   
 
 """
@@ -180,10 +359,66 @@ def message(msg):
 
 
 """
-Each ddbExportWorker is a sub-process to Scan and export one of the segments. 
-The QoSCounter is used for QoS control.
+Open an output file. When the destination is on S3, the file is written directly 
+into the S3 object. When compression is enabled, the data goes through a zstd 
+compressor, which does the compression in its own threads. The first value returned
+is the underlying file or S3StreamWriter, the second one is what the worker writes 
+into. Closing the second one also closes the first one. An uncompressed local file
+has no Python buffer, because the pages are already big and are written by writev().
+"""
+def openOutput(worker, filename, isS3, s3, s3Bucket, uploader, slots, compress):
+  if isS3:
+    sink = S3StreamWriter(worker, s3, s3Bucket, filename, uploader, slots)
+  else:
+    sink = open(filename, 'wb', buffering=(1<<20 if compress else 0))
+  if compress:
+    return sink, zstandard.ZstdCompressor(level=3, threads=2).stream_writer(sink)
+  else:
+    return sink, sink
+
+
+"""
+Each ddbScanThread runs inside a ddbExportWorker. It takes the next unclaimed segment
+from the segments queue and Scans it from the beginning to the end, until there is no
+segment left. Each page is serialized in this thread, and handed over to the worker
+through the pages queue, so that the worker only writes. The serialization of a page
+overlaps with the Scans of the other threads and with the writing of the previous 
+pages. A None in the pages queue tells the worker that this thread is over. The done
+event is only set when all the segments taken by this thread have been scanned. A 
+thread which gives up sets the stop event, which is shared by all the Scan threads of
+the worker, so the other threads stop before the next page and take no new segment.
+The segments which are not taken yet are left to the other workers.
+"""
+def ddbScanThread(worker, ddb_table, total_segments, segments, counter, pages, done, stop):
+  def put(items):
+    chunk = bytearray()
+    writeItems(chunk, items)
+    pages.put(chunk)
+  try:
+    while not stop.is_set():
+      segment = segments.get()
+      if segment is None:
+        done.set()
+        break
+      response = ddbScan(worker, ddb_table, total_segments, segment, None, counter)
+      put(response['Items'])
+      """
+      Keep on scanning the segment until the end of the segment. 
+      """
+      while 'LastEvaluatedKey' in response and not stop.is_set():
+        response = ddbScan(worker, ddb_table, total_segments, segment, response['LastEvaluatedKey'], counter)
+        put(response['Items'])
+  finally:
+    if not done.is_set():
+      stop.set()
+    pages.put(None)
+
+
+"""
+Each ddbExportWorker is a sub-process to Scan and export segments from the segments
+queue. The QoSCounter is used for QoS control.
 """   
-def ddbExportWorker(workerId, region, table, total_segments, counter, destination, size, isS3, s3Region, s3Bucket, s3Prefix):
+def ddbExportWorker(workerId, region, table, total_segments, segments, scan_threads, counter, destination, size, compress, isS3, s3Region, s3Bucket, s3Prefix):
   worker = "Worker_" + "{:04d}".format(workerId)
   """
   We start with a random sleep. This is to avoid all sub-processes performing disk 
@@ -194,172 +429,210 @@ def ddbExportWorker(workerId, region, table, total_segments, counter, destinatio
   """
   We create one DynamoDB client per worker process. This is because boto3 session 
   is not thread safe. If the destination is on S3, then we create an S3 client as 
-  well.
+  well. The DynamoDB client keeps its connections alive between Scans, and uses the
+  adaptive retry mode of boto3, which slows down the client when it is throttled. 
+  The retries in ddbScan() are only the last resort. Each Scan thread gets its own
+  DynamoDB resource, because boto3 resources are not thread safe either. They are
+  all created here, before the Scan threads start.
   """
   session = boto3.session.Session()
-  dynamodb    = session.resource('dynamodb', region_name = region)
-  ddb_table   = dynamodb.Table(table)
+  ddb_config  = Config(max_pool_connections = 50, tcp_keepalive = True, retries = {'max_attempts': 10, 'mode': 'adaptive'})
+  ddb_tables  = [session.resource('dynamodb', region_name = region, config = ddb_config).Table(table) for i in range(scan_threads)]
   if isS3:
-    s3 = session.resource('s3', region_name = s3Region)
+    s3 = session.client('s3', region_name = s3Region)
+    """
+    Output files are streamed to S3, and their parts are uploaded in the background.
+    The semaphore limits the number of parts waiting for upload, so they do not pile
+    up in memory.
+    """
+    uploader = ThreadPoolExecutor(max_workers=8)
+    slots    = threading.BoundedSemaphore(8)
+  else:
+    s3       = None
+    uploader = None
+    slots    = None
   """
-  Output filename is table-workerId-fileId.json.
+  Output filename is table-workerId-fileId.json, or table-workerId-fileId.json.zst
+  when compression is enabled. When the destination is on S3, the file is written 
+  directly into the S3 object with the same name under the prefix.
   """
-  fileId = 0
   if isS3:
-    filename = str(table) + '-' + "{:04d}".format(workerId) + '-' + "{:05d}".format(fileId) + '.json'
+    prefix = '' if s3Prefix is None else s3Prefix
   else:
-    filename = destination + str(table) + '-' + "{:04d}".format(workerId) + '-' + "{:05d}".format(fileId) + '.json'
-  out=open(filename, 'w')
-  response = ddbScan(worker, ddb_table, total_segments, workerId, None, counter)
+    prefix = destination
+  basename = prefix + str(table) + '-' + "{:04d}".format(workerId) + '-'
+  suffix   = '.json.zst' if compress else '.json'
+  fileId   = 0
+  filename = basename + "{:05d}".format(fileId) + suffix
+  sink, out = openOutput(worker, filename, isS3, s3, s3Bucket, uploader, slots, compress)
   """
-  Dump the items into the output file, one item per line. 
+  The Scans run in separate threads, so that several Scans are in flight while the
+  pages are being written. The queue only holds a few pages, so the Scans can not 
+  run too far ahead of the writing.
   """
-  for item in response['Items']:
-    out.write(json.dumps(item, default=decimal_default) + '\n')
-  scans = 1
-  """
-  Keep on scanning the segment until the end of the segment. 
-  """
-  while 'LastEvaluatedKey' in response:
-    response = ddbScan(worker, ddb_table, total_segments, workerId, response['LastEvaluatedKey'], counter)
+  pages    = queue.Queue(maxsize=scan_threads * 2)
+  dones    = []
+  scanners = []
+  stop     = threading.Event()
+  for ddb_table in ddb_tables:
+    done    = threading.Event()
+    scanner = threading.Thread(target=ddbScanThread, args=(worker, ddb_table, total_segments, segments, counter, pages, done, stop), daemon=True)
+    scanner.start()
+    dones.append(done)
+    scanners.append(scanner)
+  size_limit    = size * 1024 * 1024
+  bytes_written = 0
+  running = scan_threads
+  while running > 0:
     """
-    Dump the items into the output file, one item per line. 
+    Wait for the next page, then take all the other pages already in the queue, and
+    write them into the output file together.
     """
-    for item in response['Items']:
-      out.write(json.dumps(item, default=decimal_default) + '\n')
-    scans = scans + 1
+    chunks = []
+    chunk  = pages.get()
+    while True:
+      if chunk is None:
+        running = running - 1
+      else:
+        chunks.append(chunk)
+      try:
+        chunk = pages.get_nowait()
+      except queue.Empty:
+        break
+    writeChunks(out, chunks)
+    bytes_written = bytes_written + sum(len(chunk) for chunk in chunks)
     """
-    Create a new file when the file size approaches the size limit.
+    Create a new file when the file size reaches the size limit.
     """
-    if scans == size:
+    if bytes_written >= size_limit:
       out.close()
-      fileId = fileId + 1
-      if isS3:
-        """
-        Stage this file to S3, delete it from local disk, then create the next filename.
-        """
-        if s3Prefix is None:
-          s3Upload(worker, s3, filename, s3Bucket, filename)
-        else:
-          s3Upload(worker, s3, filename, s3Bucket, s3Prefix + filename)
-        os.remove(filename)
-        filename = str(table) + '-' + "{:04d}".format(workerId) + '-' + "{:05d}".format(fileId) + '.json'
-      else:
-        filename = destination + str(table) + '-' + "{:04d}".format(workerId) + '-' + "{:05d}".format(fileId) + '.json'
-      out=open(filename, 'w')
-      scans = 0
+      fileId   = fileId + 1
+      filename = basename + "{:05d}".format(fileId) + suffix
+      sink, out = openOutput(worker, filename, isS3, s3, s3Bucket, uploader, slots, compress)
+      bytes_written = 0
   """
-  Now we are done with scanning this segment. If the destination is S3, then we need
-  to stage the last file to S3 and delete from local disk.
+  Now we are done with scanning all the segments.
   """
+  for scanner in scanners:
+    scanner.join()
+  if not all([done.is_set() for done in dones]):
+    """
+    A Scan thread gave up after too many failed attempts. A partial S3 object is
+    not completed.
+    """
+    if isS3:
+      sink.abort()
+    else:
+      out.close()
+    sys.exit()
   out.close()
   if isS3:
-    if s3Prefix is None:
-      s3Upload(worker, s3, filename, s3Bucket, filename)
-    else:
-      s3Upload(worker, s3, filename, s3Bucket, s3Prefix + filename)
-    os.remove(filename)
+    uploader.shutdown(wait=True)
 
 
 """
 The main program starts here.
-At the beginning, nothing is defined. Enforce user-supplied values.
-"""
-region = None
-table  = None
-process_count = None
-rcu    = None
-size   = 1024
-destination  = None
+Obtain the AWS region, table name, and the number of worker processes from command line.
+argparse makes sure that all of them are defined, and that the numbers are integers.
+"""
+parser = argparse.ArgumentParser(description='Export data from a DynamoDB table into JSON files.')
+parser.add_argument('-r', dest='region', required=True, help='AWS region, such as us-east-1')
+parser.add_argument('-t', dest='table', required=True, help='DynamoDB table name')
+parser.add_argument('-p', dest='processes', type=int, required=True, help='number of worker processes')
+parser.add_argument('-c', dest='capacity', type=int, required=True, help='maximum RCU to use')
+parser.add_argument('-s', dest='size', type=int, default=1024, help='maximum size of each output file in MB (default: 1024)')
+parser.add_argument('-d', dest='destination', required=True, help='local folder or S3 path')
+parser.add_argument('-z', dest='compress', action='store_true', help='compress the output files with zstd')
+args = parser.parse_args()
+region = args.region
+table  = args.table
+process_count = args.processes
+rcu    = args.capacity
+size   = args.size
+compress = args.compress
+destination  = args.destination
 isS3   = False
 s3Region = 'us-east-1'
 s3Bucket = None
 s3Prefix = None
 """
-Obtain the AWS region, table name, and the number of worker processes from command line.
+Make sure that the numbers are greater than 0.
 """
-argv = sys.argv[1:]
-opts, args = getopt.getopt(argv, 'r:t:p:c:s:d:')
-for opt, arg in opts:
-  if opt == '-r':
-    region = arg
-  elif opt == '-t':
-    table = arg  
-  elif opt == '-d':
-    destination = arg  
-    if destination.startswith('s3://'):
-      isS3 = True
-      destination = destination[5:]
-      """
-      Dealing with S3 bucket name and prefix
-      """
-      if destination.endswith('/'):
-        destination = destination[:-1]
-      pos = destination.find('/')
-      if pos != -1:
-        s3Bucket = destination[:pos]
-        s3Prefix = destination[pos+1:] + '/'
-      else:
-        s3Bucket = destination
-        s3Prefix = None
-      s3Region = getBucketRegion(s3Bucket)
-    else:
-      if not destination.endswith('/'):
-        destination = destination + '/'
-      if not os.path.exists(destination):
-        os.makedirs(destination)
-  elif opt == '-p':
-    process_count = int(arg)
-  elif opt == '-c':
-    rcu = int(arg)
-  elif opt == '-s':
-    size = int(arg)
-"""
-Make sure that all command line parameters are defined.
-"""
-if all([region, table, process_count, rcu, destination, size]) == False:
-  print('usage:')
-  print('python DDBExport.py -r <region> -t <table> -p <processes> -c <capacity> -s <size> -d <destination>')
-else:
+if process_count <= 0 or rcu <= 0 or size <= 0:
+  parser.error('the number of processes, the capacity and the size must be greater than 0')
+if compress and zstandard is None:
+  parser.error('the zstandard module is required to compress the output (pip install zstandard)')
+if destination.startswith('s3://'):
+  isS3 = True
+  destination = destination[5:]
   """
-  Make sure the DynamoDB table exists and has the desired level of RCU. 
+  Dealing with S3 bucket name and prefix
   """
-  try:
-    session = boto3.session.Session()
-    client  = session.resource('dynamodb', region_name = region)
-    response = client.Table(table)
-    message('The DynamoDB table is ' + response.table_status + '.')
-    if response.table_status != 'ACTIVE':
-      message('The DynamoDB table must be in ACTIVE state to run DDBExport.')
-      sys.exit()
-    if response.billing_mode_summary is None:
-      message('The DynamoDB table has provisioned RCU: ' + str(response.provisioned_throughput['ReadCapacityUnits']))
-      if response.provisioned_throughput['ReadCapacityUnits'] < rcu:
-        message('The provisioned RCU is smaller than the desired capacity (' + str(rcu) + ') for DDBExport.')
-        sys.exit()
-    else:
-      message('The DynamoDB table is using on-demand capacity.')
-  except Exception as e:
-    message(str(e))
+  if destination.endswith('/'):
+    destination = destination[:-1]
+  pos = destination.find('/')
+  if pos != -1:
+    s3Bucket = destination[:pos]
+    s3Prefix = destination[pos+1:] + '/'
+  else:
+    s3Bucket = destination
+    s3Prefix = None
+  s3Region = getBucketRegion(s3Bucket)
+else:
+  if not destination.endswith('/'):
+    destination = destination + '/'
+  if not os.path.exists(destination):
+    os.makedirs(destination)
+"""
+Make sure the DynamoDB table exists and has the desired level of RCU. 
+"""
+try:
+  session = boto3.session.Session()
+  client  = session.resource('dynamodb', region_name = region)
+  response = client.Table(table)
+  message('The DynamoDB table is ' + response.table_status + '.')
+  if response.table_status != 'ACTIVE':
+    message('The DynamoDB table must be in ACTIVE state to run DDBExport.')
     sys.exit()
-  """
-  Setup the QoSCounter. 
-  """
-  counter = QoSCounter(rcu)
-  qos = multiprocessing.Process(target=qosRefillThread, args=(counter, ))
-  qos.start()
-  """
-  Launch worker processes to do the work. 
-  """
-  workers = []
-  for i in range(process_count):
-    p = multiprocessing.Process(target=ddbExportWorker, args=(i, region, table, process_count, counter, destination, size, isS3, s3Region, s3Bucket, s3Prefix))
-    workers.append(p)
-    p.start()
-  """
-  Wait for worker processes to exit, then the main thread exits.
-  """
-  for p in workers:
-    p.join()
-  qos.terminate()
-  message("All done.")
\ No newline at end of file
+  if response.billing_mode_summary is None:
+    message('The DynamoDB table has provisioned RCU: ' + str(response.provisioned_throughput['ReadCapacityUnits']))
+    if response.provisioned_throughput['ReadCapacityUnits'] < rcu:
+      message('The provisioned RCU is smaller than the desired capacity (' + str(rcu) + ') for DDBExport.')
+      sys.exit()
+  else:
+    message('The DynamoDB table is using on-demand capacity.')
+except Exception as e:
+  message(str(e))
+  sys.exit()
+"""
+Setup the QoSCounter. 
+"""
+counter = QoSCounter(rcu)
+"""
+Split the table into more segments than worker processes. Each worker takes the
+next unclaimed segment from the queue when it is done with the previous one, so a
+worker with small segments does not sit idle while another one is still busy with
+a big segment. Each worker runs several Scan threads, and there is one None at the
+end of the queue for each Scan thread.
+"""
+total_segments = process_count * 8
+scan_threads   = 4
+segments = multiprocessing.Queue()
+for i in range(total_segments):
+  segments.put(i)
+for i in range(process_count * scan_threads):
+  segments.put(None)
+"""
+Launch worker processes to do the work. 
+"""
+workers = []
+for i in range(process_count):
+  p = multiprocessing.Process(target=ddbExportWorker, args=(i, region, table, total_segments, segments, scan_threads, counter, destination, size, compress, isS3, s3Region, s3Bucket, s3Prefix))
+  workers.append(p)
+  p.start()
+"""
+Wait for worker processes to exit, then the main thread exits.
+"""
+for p in workers:
+  p.join()
+message("All done.")
\ No newline at end of file
@@ -9,7 +9,8 @@ Example:
   python DDBImport.py -r us-east-1 -t TestTable -s data/ -p 8 -c 1000
   
 The script launches multiple processes to do the work. The processes poll from a
-common queue for data to write. 
+common queue for data to write. Each process keeps up to 8 write requests in flight
+with a thread pool, so there is no need for more processes than vCPU cores.
 
 It is safe to use 1 process per vCPU core. If you have an EC2 instance with 4 vCPU 
 cores, it is OK to set the process count to 4. The BatchWriteItem API is used to
@@ -25,87 +26,215 @@ approximately 32,000 (average value over a 1-minute period).
 
 #!/usr/bin/python
 import os
+import io
 import sys
 import json
 import time
 import boto3
-import math
 import random
+import mmap
 import multiprocessing
-import getopt
+import argparse
 from glob import glob
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import ijson
+except ImportError:
+  ijson = None
 
 """
-QoSCounter is a LeakyBucket QoS algorithm. Each sub-process can not do any Scan 
-unless the QoSCounter is greater than 0. After a sub-process performs a Scan, it
-must deduct the consumed RCU from the QoSCounter by calling the consume() method. 
-The main process needs to start a separate process to call the refill() method
-at 1 Hz to refill the LeakyBucket. 
+QoSCounter is a LeakyBucket QoS algorithm. Each sub-process can not do any write 
+unless the QoSCounter is greater than 0. After a sub-process performs a write, it
+must deduct the consumed WCU from the QoSCounter by calling the consume() method. 
+There is no refill process. The state of the LeakyBucket is the time when it is full
+again on the monotonic clock, which is shared by all processes. The capacity at any
+moment is derived from that time.
 """
 class QoSCounter(object):
     def __init__(self, value=0):
         """
-        RawValue because we don't need it to create a Lock:
+        RawValue because we don't need it to create a Lock. The bucket starts full.
         """
-        self.capacity   = multiprocessing.RawValue('i', value)
+        self.fullTime   = multiprocessing.RawValue('d', time.monotonic())
         self.refillRate = multiprocessing.RawValue('i', value)
         self.lock       = multiprocessing.Lock()
 
     def consume(self, value=0):
+        """
+        Consuming WCU pushes the time when the bucket is full further out. Here we 
+        assume limit capacity for the LeakyBucket. The underlying assumption is unused
+        capacity in the previous second can't be counted towards burst capacity. This
+        is because unused capacity is usually the result of throttling from the 
+        service side. A bucket which is already full starts from now.
+        """
         with self.lock:
-            self.capacity.value -= value
+            self.fullTime.value = max(self.fullTime.value, time.monotonic()) + value / self.refillRate.value
 
-    def refill(self):
+    def value(self):
         """
-        Here we assume limit capacity for the LeakyBucket. The underlying assumption
-        is unused capacity in the previous second can't be counted towards burst capacity.
-        This is because unused capacity is usually the result of throttling from the
-        service side.
-        """ 
-        with self.lock:
-            self.capacity.value += self.refillRate.value
-            if self.capacity.value > self.refillRate.value:
-              self.capacity.value = self.refillRate.value
+        The capacity is the refill rate, less what is still to be refilled. The state 
+        is a single double, which is written at once, so it is read without taking the
+        lock. The lock is only needed for the read-modify-write in consume().
+        """
+        rate = self.refillRate.value
+        return rate * (1 - max(0, self.fullTime.value - time.monotonic()))
+
+    def wait(self):
+        """
+        Block until the QoSCounter is greater than 0. The time it takes to refill the
+        deficit is known, so there is no need to poll.
+        """
+        capacity = self.value()
+        while capacity <= 0:
+            time.sleep(-capacity / self.refillRate.value + 0.01)
+            capacity = self.value()
+
+"""
+LocalQoSCounter is used by a worker process in place of the shared QoSCounter. The
+consumed WCU is collected locally, and deducted from the QoSCounter once there is at
+least 32 WCU, so the lock of the QoSCounter is not taken for every item. The value
+of the QoSCounter is read again when the local WCU is deducted, or when the local 
+view of the capacity runs out.
+"""
+class LocalQoSCounter(object):
+    def __init__(self, counter, threshold=32):
+        self.counter   = counter
+        self.threshold = threshold
+        self.pending   = 0
+        self.capacity  = counter.value()
+
+    def consume(self, value=0):
+        self.pending += value
+        if self.pending >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self.pending > 0:
+            self.counter.consume(self.pending)
+            self.pending = 0
+        self.capacity = self.counter.value()
 
     def value(self):
-        with self.lock:
-            return self.capacity.value
+        if self.capacity - self.pending <= 0:
+            self.capacity = self.counter.value()
+        return self.capacity - self.pending
+
+    def wait(self):
+        """
+        When the capacity runs out, the local WCU is deducted first, so that the wait
+        on the QoSCounter covers it.
+        """
+        if self.value() <= 0:
+            self.flush()
+            self.counter.wait()
+            self.capacity = self.counter.value()
 
 """
-This is a thread to refill the QoSCounter once every second.
+Check if there is any float in the values of a parsed item, including the values
+nested in maps and lists.
 """
-def qosRefillThread(counter):
-  while True:
-      counter.refill()
-      time.sleep(1)
-      
+def hasFloat(values):
+  for value in values:
+    if isinstance(value, float):
+      return True
+    elif isinstance(value, dict) and hasFloat(value.values()):
+      return True
+    elif isinstance(value, list) and hasFloat(value):
+      return True
+  return False
+
+"""
+ItemParser converts the lines of one source into DynamoDB items. orjson is used when
+it is installed. boto3 does not accept floats, and a float parsed by orjson might 
+have lost digits of the number in the file, so a line with any float in it is parsed
+again by json with the numbers converted into Decimals. A source with one float 
+usually has floats in every line, such as the files written by DDBExport, so once a
+float is found, the rest of the source is parsed by json directly. json is also used
+when orjson can not handle the line. A new ItemParser is used for each file, range,
+batch or S3 object.
+"""
+class ItemParser(object):
+    def __init__(self):
+        self.floats = orjson is None
+
+    def parse(self, line):
+        if not self.floats:
+            try:
+                item = orjson.loads(line)
+                if isinstance(item, dict) and not hasFloat(item.values()):
+                    return item
+                self.floats = True
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(line, parse_float=Decimal)
 
 """
-Write one item.
+Exponential backoff for waiting on unprocessed items. The sleep time starts from
+50 ms and doubles with each attempt, up to 1 second, with a small random jitter so
+the worker processes do not wake up together. The exponent is capped first, so a 
+long run of attempts does not overflow the float.
 """
-def writeItem(items, line, counter):
+def backoff(attempt):
+  return min(0.05 * (2 ** min(attempt, 5)), 1.0) + random.random() * 0.05
+
+"""
+Convert a value parsed from JSON into the DynamoDB attribute value format. JSON only
+has a few types, so they are checked directly, which is faster than the generic
+TypeSerializer. Anything else is left to the TypeSerializer.
+"""
+def toAttribute(value, serializer):
+  t = type(value)
+  if t is str:
+    return {'S': value}
+  elif t is int or t is Decimal:
+    return {'N': str(value)}
+  elif t is dict:
+    return {'M': {k: toAttribute(v, serializer) for k, v in value.items()}}
+  elif t is list:
+    return {'L': [toAttribute(v, serializer) for v in value]}
+  elif t is bool:
+    return {'BOOL': value}
+  elif value is None:
+    return {'NULL': True}
+  else:
+    return serializer.serialize(value)
+
+"""
+Add one item to the next BatchWriteItem request. A line is parsed by the ItemParser
+of its source, and the item is converted into the DynamoDB attribute value format by
+toAttribute(). An item from a JSON array is already parsed, and its size is only 
+needed for the WCU estimation.
+"""
+def writeItem(items, line, counter, serializer, parser):
   """
   Before doing any work, wait for QoSCounter to be greater than zero. 
   """
-  while counter.value() <= 0:
-    time.sleep(1)
-  size = len(line)
-  item = json.loads(line, parse_float=Decimal)
-  items.append(item)
+  counter.wait()
+  if isinstance(line, dict):
+    item = line
+    size = len(json.dumps(item, default=str))
+  else:
+    size = len(line)
+    item = parser.parse(line)
+  items.append({'PutRequest': {'Item': {k: toAttribute(v, serializer) for k, v in item.items()}}})
   """
   Consume (size/1024) WCU from the counter. This is only an estimation.
   """
-  counter.consume(math.ceil(size/1024))
+  counter.consume((size + 1023) >> 10)
 
 """
 Get the string representation of the current day and time.
 """   
 def getTime():
-  now = datetime.now()
-  current_time = now.strftime("%Y-%m-%dT%H:%M:%S")
-  return current_time
+  return time.strftime("%Y-%m-%dT%H:%M:%S")
 
 """
 Print out message with the current day and time.
@@ -113,56 +242,188 @@ Print out message with the current day and time.
 def message(msg):
   print(getTime() + ' ' + msg)
 
+"""
+Print out a warning, unless the same warning has already been printed in the last
+second. During a throttling burst, all the requests in flight fail with the same 
+error, and printing every one of them only slows the worker down. The number of 
+warnings skipped is printed with the next one, or by flushWarnings() when the 
+worker exits.
+"""
+lastWarnings = {}
+def warning(msg):
+  now = time.monotonic()
+  last, skipped = lastWarnings.get(msg, (0, 0))
+  if now - last < 1:
+    lastWarnings[msg] = (last, skipped + 1)
+    return
+  if len(lastWarnings) > 1000:
+    lastWarnings.clear()
+  lastWarnings[msg] = (now, 0)
+  if skipped > 0:
+    message(msg + ' (repeated ' + str(skipped) + ' times)')
+  else:
+    message(msg)
 
 """
-Perform a DynamoDB PutItem, with application -level retries. The application-level retries are
-in addition to the automatic retries in boto3.
+Print out the number of warnings skipped since each warning was last printed, so
+the end of the last burst is not lost when the worker exits.
 """
-def ddbWrite(worker, counter, ddb_table, line):
+def flushWarnings():
+  for msg, (last, skipped) in list(lastWarnings.items()):
+    if skipped > 0:
+      message(msg + ' (repeated ' + str(skipped) + ' more times)')
+  lastWarnings.clear()
+
+
+"""
+The error codes of BatchWriteItem which are worth a retry.
+"""
+retryable_errors = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError', 'ServiceUnavailable')
+
+"""
+Perform a DynamoDB BatchWriteItem, with application -level retries. The application-level retries are
+in addition to the automatic retries in boto3. The unprocessed items returned by 
+DynamoDB are written again, until all the items are written. Only throttling and
+server-side errors are retried, with decorrelated jitter between 100 ms and 20 
+seconds, so the worker processes do not retry at the same time. Other errors, such 
+as an invalid item, would only fail again.
+"""
+def ddbWrite(worker, client, table, items):
   ddb_max_retries  = 10
   ddb_retry_count  = 0
-  ddb_retry_needed = True
-  """
-  Before doing any work, wait for QoSCounter to be greater than zero. 
-  """
-  while counter.value() <= 0:
-    time.sleep(1)
-  """
-  Convert the line into a DynamoDB item, also take the size 
-  """
-  size = len(line)
-  item = json.loads(line, parse_float=Decimal)
-  """
-  The QoSCounter is greater than 0. Perform the Scan 
-  """
-  while ddb_retry_count < ddb_max_retries and ddb_retry_needed:
+  ddb_retry_sleep  = 0.1
+  unprocessed_count = 0
+  while len(items) > 0 and ddb_retry_count < ddb_max_retries:
     try:
+      response = client.batch_write_item(RequestItems={table: items})
+      items = response['UnprocessedItems'].get(table, [])
       """
-      DynamoDB PutItem
+      Unprocessed items mean that DynamoDB is throttling the writes. Back off before
+      writing them again.
       """
-      ddb_table.put_item(Item=item)
-      """
-      Consume (size/1024) WCU from the counter. This is only an estimation.
-      """
-      counter.consume(math.ceil(size/1024))
-      ddb_retry_needed = False
-    except Exception as e:
+      if len(items) > 0:
+        time.sleep(backoff(unprocessed_count))
+        unprocessed_count = unprocessed_count + 1
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ValidationException' and 'duplicates' in str(e) and len(items) > 1:
+        """
+        A BatchWriteItem request can not have the same key twice, which is fine with
+        PutItem. Write the items one by one in this case, so the last one wins.
+        """
+        for item in items:
+          ddbWrite(worker, client, table, [item])
+        return
+      warning(worker + ': ' + str(e))
+      if e.response['Error']['Code'] not in retryable_errors:
+        message(worker + ': Killing DDBImport due to an error which can not be retried.')
+        sys.exit()
       ddb_retry_count = ddb_retry_count + 1
-      message(worker + ': ' + str(e))
+      ddb_retry_sleep = min(20, random.uniform(0.1, ddb_retry_sleep * 3))
+      time.sleep(ddb_retry_sleep)
+    except Exception as e:
       """
-      Very aggressive sleep for 5, 10, 15, 20, 25... seconds to deal with throttling
+      Connection errors are retried as well.
       """
-      time.sleep(ddb_retry_count * 5)
-  if ddb_retry_count >= ddb_max_retries and ddb_retry_needed:
+      ddb_retry_count = ddb_retry_count + 1
+      warning(worker + ': ' + str(e))
+      ddb_retry_sleep = min(20, random.uniform(0.1, ddb_retry_sleep * 3))
+      time.sleep(ddb_retry_sleep)
+  if len(items) > 0:
     """
     If the application-level retries also fail, we have tried our best. It is time to
     give up.
     """
-    message(worker + ': ' + str(ddb_max_retries) + ' DynamoDB PutItem attempts failed.')
+    message(worker + ': ' + str(ddb_max_retries) + ' DynamoDB BatchWriteItem attempts failed.')
     message(worker + ': Killing DDBImport due to retry limits exceeded.')
     sys.exit()
     
     
+"""
+Download the first bytes of an S3 object with a ranged GetObject. The head, the ETag
+and the size of the S3 object are returned. An empty S3 object can not be read with
+a range, and it has no bytes to return anyway.
+"""
+def getObjectHead(s3, bucket, key, size=8*1024*1024):
+  try:
+    response = s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-' + str(size - 1))
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'InvalidRange':
+      return b'', None, 0
+    raise
+  data = response['Body'].read()
+  if 'ContentRange' in response:
+    total = int(response['ContentRange'].split('/')[-1])
+  else:
+    total = len(data)
+  return data, response['ETag'], total
+
+"""
+Read an S3 object, starting with the head downloaded by getObjectHead(). The rest of
+the S3 object is only requested now, with the ETag of the head, so the two parts are
+always from the same version of the S3 object.
+"""
+def getObjectRest(s3, bucket, key, head):
+  data, etag, total = head
+  if total > len(data):
+    body = s3.get_object(Bucket=bucket, Key=key, Range='bytes=' + str(len(data)) + '-', IfMatch=etag)['Body']
+  else:
+    body = io.BytesIO()
+  return HeadReader(data, body)
+
+"""
+Read the lines to import from the queue, whatever the queue_type is. The lines of 
+each file, range, batch or S3 object are returned together, as one iterable. Each
+worker stops when it gets a None from the queue.
+"""
+def readQueue(worker, session, queue, queue_type, s3Region, s3Bucket):
+  if queue_type == 'S3Object':
+    """
+    When the source_type is S3Object, each record in the queue is an S3 object. The
+    first 8 MB of the next S3 object are downloaded in the background while the 
+    current S3 object is being imported, so the next S3 object is ready to be read 
+    when the current one is done. The head is read completely, because S3 closes the
+    connection of a response body which is not read for a long time.
+    """
+    s3 = session.client('s3', region_name = s3Region)
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    keys = iter(queue.get, None)
+    key  = next(keys, None)
+    if key is not None:
+      future = prefetch.submit(getObjectHead, s3, s3Bucket, key)
+    while key is not None:
+      head = future.result()
+      next_key = next(keys, None)
+      if next_key is not None:
+        future = prefetch.submit(getObjectHead, s3, s3Bucket, next_key)
+      message(worker + ' is importing s3://' + s3Bucket + '/' + key)
+      yield splitLines(getObjectRest(s3, s3Bucket, key, head))
+      key = next_key
+    prefetch.shutdown()
+  elif queue_type == 'FILE':
+    """
+    When the source_type is FILE, each record in the queue is a filename. The file
+    is read as bytes, because the JSON parsers take bytes, and there is no need to
+    decode the lines into strings first.
+    """
+    for file in iter(queue.get, None):
+      message(worker + ' is importing ' + file)
+      with open(file, 'rb', buffering=1<<20) as f:
+        yield splitLines(f)
+  elif queue_type == 'RANGE':
+    """
+    When the queue_type is RANGE, each record in the queue is a byte range of a 
+    file, which is read through a memory map.
+    """
+    for file, start, end in iter(queue.get, None):
+      with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield mm[start:end].splitlines()
+  elif queue_type == 'LINE':
+    """
+    When the queue_type is LINE, each record in the queue is a batch of items.
+    """
+    for lines in iter(queue.get, None):
+      yield lines
+
 """
 Each ddbImportWorker is a sub-process to read data and write to DynamoDB. 
 The QoSCounter is used for QoS control.
@@ -171,64 +432,197 @@ def ddbImportWorker(workerId, ddbRegion, table, queue, queue_type, counter, s3Re
   worker = "Worker_" + "{:04d}".format(workerId)
   """
   We create one DynamoDB client per worker process. This is because boto3 session 
-  is not thread safe. 
+  is not thread safe. The low-level client is used, so the items are converted into 
+  the DynamoDB format only once, by the TypeSerializer of the worker. The client 
+  keeps enough connections alive for all the requests in flight, and uses the 
+  adaptive retry mode of boto3, which slows down the client when it is throttled.
   """
   session  = boto3.session.Session()
-  dynamodb = session.resource('dynamodb', region_name = ddbRegion)
-  ddb_table   = dynamodb.Table(table)
+  ddb_config = Config(max_pool_connections = 32, tcp_keepalive = True, retries = {'max_attempts': 10, 'mode': 'adaptive'})
+  client   = session.client('dynamodb', region_name = ddbRegion, config = ddb_config)
+  serializer = TypeSerializer()
   items = []
-  if queue_type == 'S3Object':
-    """
-    When the source_type is S3Object, each record in the queue is an S3 object.
-    """
-    s3 = boto3.resource('s3', region_name = s3Region)
-    has_more_work = True
-    while has_more_work:
-      try:
-        key = queue.get(timeout=1)
-        message(worker + ' is importing s3://' + s3Bucket + '/' + key)
-        obj = s3.Object(s3Bucket, key)
-        for line in obj.get()['Body']._raw_stream:
-            ddbWrite(worker, counter, ddb_table, line)
-      except Exception as e:
-        message(worker + ' ' + type(e).__name__)
-        if type(e).__name__ is not 'Empty':
-          message(worker + ' ' + str(e))
-        has_more_work = False  
-        sys.exit()
-  if queue_type == 'FILE':
-    """
-    When the source_type is FILE, each record in the queue is a filename.
-    """
-    has_more_work = True
-    while has_more_work:
-      try:
-        file = queue.get(timeout=1)
-        message(worker + ' is importing ' + file)
-        with open(file) as f:
-          for line in f:
-            ddbWrite(worker, counter, ddb_table, line)
-      except Exception as e:
-        message(worker + ' ' + type(e).__name__)
-        if type(e).__name__ is not 'Empty':
-          message(worker + ' ' + str(e))
-        has_more_work = False  
-        sys.exit()
-  elif queue_type == 'LINE':
+  counter = LocalQoSCounter(counter)
+  """
+  The items are written in BatchWriteItem requests of 25 items, which is the most
+  that BatchWriteItem takes. The requests are sent by a thread pool, so that up to 8
+  requests are in flight while the next items are being prepared. The low-level 
+  client is thread safe. The result of each request is checked, so a request which
+  gives up also stops the worker.
+  """
+  pool     = ThreadPoolExecutor(max_workers=8)
+  inflight = set()
+  def submit(batch):
+    if len(inflight) >= 8:
+      done, pending = wait(inflight, return_when=FIRST_COMPLETED)
+      for future in done:
+        inflight.remove(future)
+        future.result()
+    inflight.add(pool.submit(ddbWrite, worker, client, table, batch))
+  """
+  The lines from the queue are turned into items, which are written in batches.
+  """
+  try:
+    for lines in readQueue(worker, session, queue, queue_type, s3Region, s3Bucket):
+      parser = ItemParser()
+      for line in lines:
+        writeItem(items, line, counter, serializer, parser)
+        if len(items) >= 25:
+          submit(items[:])
+          items.clear()
     """
-    When the queue_type is LINE, each record in the queue is an item.
+    Write the last items, which are less than 25, and wait for all the requests.
     """
-    has_more_work = True
-    while has_more_work:
-      try:
-        line = queue.get(timeout=2)
-        ddbWrite(worker, counter, ddb_table, line)
-      except Exception as e:
-        message(worker + ' ' + type(e).__name__)
-        if type(e).__name__ is not 'Empty':
-          message(worker + ' ' + str(e))
-        has_more_work = False  
-        sys.exit()
+    if len(items) > 0:
+      submit(items[:])
+    for future in inflight:
+      future.result()
+    pool.shutdown(wait=True)
+  except Exception as e:
+    message(worker + ' ' + type(e).__name__)
+    message(worker + ' ' + str(e))
+    sys.exit()
+  finally:
+    counter.flush()
+    flushWarnings()
+
+"""
+Split a file into lines, reading 4 MB at a time. Each chunk is split with a single
+call, instead of looking for the end of each line separately. The part after the 
+last newline in a chunk is carried over to the next chunk. The lines are returned 
+without the newline.
+"""
+def splitLines(f, chunk_size=4*1024*1024):
+  pending = b''
+  while True:
+    chunk = f.read(chunk_size)
+    if not chunk:
+      break
+    lines = (pending + chunk).split(b'\n')
+    pending = lines.pop()
+    yield from lines
+  if pending:
+    yield pending
+
+"""
+HeadReader returns the first bytes of a stream, which have already been read, before
+the rest of the stream. Only read() is needed by splitLines() and ijson, so any
+stream with a read() method works, including the StreamingBody of an S3 object.
+"""
+class HeadReader(object):
+    def __init__(self, head, f):
+        self.head = head
+        self.f    = f
+
+    def read(self, size=-1):
+        if self.head:
+            if size < 0:
+                data, self.head = self.head + self.f.read(), b''
+            else:
+                data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.f.read(size)
+
+"""
+Read the items in a single JSON file. A file with one item per line is read line by
+line. A file with a JSON array is parsed by ijson as a stream, so a big array is 
+never loaded into memory. The items in the array are passed on as parsed, with the 
+numbers with a fraction as Decimal, so no digit is lost. The first bytes are read to
+check for a JSON array, and are put back in front of the stream.
+"""
+def readLines(f):
+  head = f.read(64)
+  f = HeadReader(head, f)
+  if head.lstrip().startswith(b'['):
+    if ijson is None:
+      message('The source is a JSON array, which needs ijson. Please pip install ijson.')
+      sys.exit(1)
+    yield from ijson.items(f, 'item', use_float=False)
+  else:
+    yield from splitLines(f)
+
+"""
+Put the items in a single JSON file into the queue, in batches of 500 lines or 
+parsed items. Each put() pickles the batch and sends it through a pipe, which costs
+about the same for a batch as for a single line.
+"""
+def queueLines(f, queue):
+  batch = []
+  for line in readLines(f):
+    batch.append(line)
+    if len(batch) >= 500:
+      queue.put(batch)
+      batch = []
+  if batch:
+    queue.put(batch)
+
+"""
+Check if a local file is a JSON array, by looking at the first character.
+"""
+def isJsonArray(file):
+  with open(file, 'rb') as f:
+    return f.read(64).lstrip().startswith(b'[')
+
+"""
+Split a local file into byte ranges, which can be imported separately. Each range
+ends right after a newline, so no line is split between two ranges. The ranges are
+shuffled to avoid hot partitions.
+"""
+def fileRanges(file, count):
+  ranges = []
+  size   = os.path.getsize(file)
+  if size == 0:
+    return ranges
+  with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    start = 0
+    for i in range(1, count + 1):
+      pos = mm.find(b'\n', max(start, i * size // count - 1))
+      end = size if i == count or pos == -1 else pos + 1
+      if end > start:
+        ranges.append((file, start, end))
+        start = end
+  random.shuffle(ranges)
+  return ranges
+
+"""
+The producer is a sub-process to fill the queue, while the worker processes are
+already taking work from the queue. The queue is bounded, so the producer waits when
+the workers fall behind. When the source is a single file, the items in the file are
+put into the queue. Otherwise, the filenames or the S3 object keys are put into the
+queue. When the source is a single local file with one item per line, the byte ranges
+of the file are put into the queue. At the end, there is one None in the queue for 
+each worker process, even when the producer fails. A failed producer exits with an
+error, so the main process does not report a partial import as done.
+"""
+def producer(queue, queue_type, sources, s3Region, s3Bucket, process_count):
+  try:
+    if queue_type == 'LINE' and s3Bucket is not None:
+      """
+      The body of the S3 object is read directly. splitLines() only calls read(), so
+      there is no need for io.BufferedReader, which needs a readinto() that older
+      versions of botocore do not have.
+      """
+      s3 = boto3.client('s3', region_name = s3Region)
+      body = s3.get_object(Bucket=s3Bucket, Key=sources[0])['Body']
+      queueLines(body, queue)
+    elif queue_type == 'LINE':
+      """
+      The file is read in 1 MB chunks, and the kernel is told that the file is read
+      sequentially, so it reads further ahead of the producer.
+      """
+      with open(sources[0], 'rb', buffering=1<<20) as f:
+        if hasattr(os, 'posix_fadvise'):
+          os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        queueLines(f, queue)
+    else:
+      for source in sources:
+        queue.put(source)
+  except Exception as e:
+    message('Producer: ' + str(e))
+    sys.exit(1)
+  finally:
+    for i in range(process_count):
+      queue.put(None)
 
 """
 Retrieve the AWS region for the S3 bucket.
@@ -296,38 +690,29 @@ def listLocalFiles(source):
   
   
 """
-At the beginning, nothing is defined. Enforce user-supplied values.
+Obtain the AWS region, table name, source file, and the number of worker processes
+from command line. argparse makes sure that all of them are defined, and that the 
+numbers are integers.
 """
-region = None
-table  = None
-source = None
-wcu    = None
-process_count = None
+parser = argparse.ArgumentParser(description='Import data from JSON files into a DynamoDB table.')
+parser.add_argument('-r', dest='region', required=True, help='AWS region, such as us-east-1')
+parser.add_argument('-t', dest='table', required=True, help='DynamoDB table name')
+parser.add_argument('-s', dest='source', required=True, help='local file, local folder, S3 object or S3 prefix')
+parser.add_argument('-p', dest='processes', type=int, required=True, help='number of worker processes')
+parser.add_argument('-c', dest='capacity', type=int, required=True, help='maximum WCU to use')
+args = parser.parse_args()
+region = args.region
+table  = args.table
+source = args.source
+wcu    = args.capacity
+process_count = args.processes
 s3Bucket = None
 s3Region = 'us-east-1'
 """
-Obtain the AWS region, table name, source file, and the number of worker processes
-from command line.
-"""
-argv = sys.argv[1:]
-opts, args = getopt.getopt(argv, 'r:t:s:p:c:')
-for opt, arg in opts:
-  if opt == '-r':
-    region = arg
-  elif opt == '-t':
-    table = arg  
-  elif opt == '-s':
-    source = arg  
-  elif opt == '-p':
-    process_count = int(arg)
-  elif opt == '-c':
-    wcu = int(arg)
-"""
-Make sure that all command line parameters are defined.
-"""
-if all([region, table, source, process_count, wcu]) == False:
-  print('usage:')
-  print('DDBImport.py -r <region_name> -t <table_name> -s <source> -p <processes> -c capacity')
+Make sure that the numbers are greater than 0.
+"""
+if process_count <= 0 or wcu <= 0:
+  parser.error('the number of processes and the capacity must be greater than 0')
 else:
   """
   Make sure the DynamoDB table exists and has the desired level of WCU. 
@@ -351,10 +736,6 @@ else:
     message(str(e))
     sys.exit()
   """
-  Create a queue to distribute the work.
-  """
-  queue = multiprocessing.Queue()
-  """
   Check if the input source is an S3 path, a file, or a folder.
   """
   if source.startswith('s3://'):
@@ -379,17 +760,12 @@ else:
       There is only one S3 object with .json filename, need to write to the queue line by line
       """
       queue_type = 'LINE'
-      s3 = boto3.resource('s3', region_name = s3Region)
-      obj = s3.Object(s3Bucket, objects[0])
-      for line in obj.get()['Body']._raw_stream:
-        queue.put(line)
     else:
       """
       There are multiple S3 object with .json filename, need to write object key names to the queue
       """
       queue_type = 'S3Object'
-      for obj in objects:
-        queue.put(obj)
+    sources = objects
   else:
     """
     Retrieve all JSON files in the source location
@@ -402,27 +778,38 @@ else:
       """
       message('Can not find any .json file in the source location.')
       sys.exit()
-    elif len(files) == 1:
+    elif len(files) == 1 and isJsonArray(files[0]):
       """
-      There is only one .json file
+      There is only one .json file, which is a JSON array. It is parsed by ijson, so
+      make sure ijson is there before any work is started.
       """
+      if ijson is None:
+        parser.error('the source is a JSON array, which needs the ijson module (pip install ijson)')
       queue_type = 'LINE'
-      with open(source) as f:
-        for line in f:
-          queue.put(line)
+      sources = files
+    elif len(files) == 1:
+      """
+      There is only one .json file with one item per line. Each worker reads its own
+      ranges of the file, so nobody has to read the file and pass the lines along.
+      """
+      queue_type = 'RANGE'
+      sources = fileRanges(files[0], max(process_count * 8, os.path.getsize(files[0]) // (16*1024*1024)))
     else:
       """
       There are multiple .json files, need to write filenames to the queue
       """
       queue_type = 'FILE'
-      for file in files:
-        queue.put(file)
+      sources = files
   """
   Setup the QoSCounter. 
   """
   counter = QoSCounter(wcu)
-  qos = multiprocessing.Process(target=qosRefillThread, args=(counter, ))
-  qos.start()
+  """
+  Create a queue to distribute the work, and start the producer to fill it.
+  """
+  queue = multiprocessing.Queue(maxsize=process_count * 64)
+  feeder = multiprocessing.Process(target=producer, args=(queue, queue_type, sources, s3Region, s3Bucket, process_count))
+  feeder.start()
   """
   Launch worker processes to do the work. The worker processes receives data from a
   queue.
@@ -437,5 +824,15 @@ else:
   """
   for p in workers:
     p.join()
-  qos.terminate()
+  """
+  The producer has normally finished by now. It is only still running when all the
+  workers have stopped early, and then it is stuck on a full queue.
+  """
+  feeder.join(5)
+  if feeder.is_alive():
+    feeder.terminate()
+    feeder.join()
+  if feeder.exitcode != 0:
+    message('The producer failed. The import is not complete.')
+    sys.exit(1)
   message("All done.")
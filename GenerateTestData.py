@@ -9,11 +9,21 @@ Example:
 """
 
 #!/usr/bin/python
+import os
 import sys
-import uuid
 import random
 import getopt
 
+"""
+Generate n random version 4 UUIDs. The random bytes for all of them are obtained 
+with a single os.urandom() call, and the version and variant bits are set in the 
+hex string, which is much faster than calling uuid.uuid4() for each UUID.
+"""
+def randomUUIDs(n):
+  h = os.urandom(16 * n).hex()
+  for k in range(0, 32 * n, 32):
+    yield '%s-%s-4%s-%s%s-%s' % (h[k:k+8], h[k+8:k+12], h[k+13:k+16], '89ab'[int(h[k+16], 16) & 3], h[k+17:k+20], h[k+20:k+32])
+
 """
 At the beginning, nothing is defined. Enforce user-supplied values.
 """
@@ -36,13 +46,14 @@ if all([total, file]) == False:
   print('usage:')
   print('GenerateTestData.py -c <item_count> -f <output_file>')
 else:
-  out=open(file, 'w')
   """
-  Write n items, one item per line.
+  Write n items, one item per line. The items are generated in blocks of 10000, and
+  each block is written into the file with a single write() call.
   """
-  for i in range(total):
-    hash  = str(uuid.uuid4())
-    range = str(uuid.uuid4())
-    val_1 = random.randrange(2147483647)
-    val_2 = str(uuid.uuid4())
-    out.write('{"hash": "%s", "range": "%s", "val_1": %d, "val_2": "%s"}\n' % (hash, range, val_1, val_2))
+  block = 10000
+  with open(file, 'wb', buffering=1<<20) as out:
+    for start in range(0, total, block):
+      count = min(block, total - start)
+      uuids = randomUUIDs(3 * count)
+      lines = ['{"hash": "%s", "range": "%s", "val_1": %d, "val_2": "%s"}\n' % (next(uuids), next(uuids), random.randrange(2147483647), next(uuids)) for i in range(count)]
+      out.write(''.join(lines).encode('utf-8'))